@@ -36,10 +36,10 @@
 #       "nbuilds": <number-of-buildbot-builds-history-to-look-at>,
 #       "buildbot": "<buildbot-url>",
 #       "gh_user": "<github-user-to-run-as>",
-#       "gh_pass": "<password-for-that-user>"
+#       "gh_token": "<access-token-for-that-user>"
 # }
 #
-# For example, the rust config at the time of writing (minus password) is:
+# For example, the rust config at the time of writing (minus token) is:
 #
 # {
 #       "owner": "mozilla",
@@ -50,7 +50,7 @@
 #       "nbuilds": 5,
 #       "buildbot": "http://buildbot.rust-lang.org",
 #       "gh_user": "bors",
-#       "gh_pass": "..."
+#       "gh_token": "..."
 # }
 #
 #
@@ -80,18 +80,39 @@
 #     - if ffwd fails, set ERROR (someone moved target-branch on us)
 
 import argparse
+import collections
 import json
+import os
 import urllib.request, urllib.error, urllib.parse
 import re
+import threading
+import time
 import logging
 import logging.handlers
 import github
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+try:
+    # Optional: several times faster than json on big buildbot responses,
+    # and on the status and cache files we write every run.
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
 from time import strftime, gmtime
 
 __version__ = '1.2'
 
 TIMEOUT=60
 
+# attempts at a buildbot fetch before giving up on the run
+BUILDBOT_TRIES=4
+CHECKS_PER_PAGE=100
+
 BUILDBOT_STATUS_SUCCESS = 0
 BUILDBOT_STATUS_WARNINGS = 1
 BUILDBOT_STATUS_FAILURE = 2
@@ -124,33 +145,109 @@ def state_name(n):
              "CLOSED" ][n+2]
 
 class BuildBot:
-    def __init__(self, cfg):
+    def __init__(self, cfg, cache=None, results=None, batch_failed=False):
         self.log = logging.getLogger("buildbot")
         self.cfg = cfg
         self.url = self.cfg["buildbot"]
         self.builders = [ x for x in self.cfg["builders"] ]
         self.nbuilds = self.cfg["nbuilds"]
-        self.revs = {}
-        self.get_status()
-
-    def get_status(self):
+        # loaded on the first test_status(), so a run with nothing pending
+        # never talks to buildbot
+        self.revs = None
+        # url -> [etag, last-modified, digested response] from last time
+        self.old_cache = cache or {}
+        self.cache = {}
+        # sha -> {builder: build} for builders that had finished testing a
+        # sha as of last run; those needn't be asked about it again
+        self.old_results = results or {}
+        self.results = {}
+        self.fetched = set()
+        # set once this buildbot has turned down a batched fetch; it's not
+        # asked again, this run or later ones, until bors-cache.json goes
+        self.batch_failed = batch_failed
+
+    def get_status(self, builders):
         self.log.info("loading build/test status from buildbot")
-        for builder in self.builders:
-            for (rev, b) in self.rev_build_pairs(builder):
-                if rev not in self.revs:
-                    self.revs[rev] = {}
-
+        self.fetched.update(builders)
+        pairs = None
+        if self.cfg.get("buildbot_batch_json") and not self.batch_failed:
+            pairs = self.batched_rev_build_pairs(builders)
+        if pairs is None:
+            # Each builder is a separate blocking fetch with nothing shared
+            # between them, so issue them all at once and merge afterwards.
+            with ThreadPoolExecutor(max_workers=max(1, len(builders))) as ex:
+                pairs = list(ex.map(lambda builder: list(self.rev_build_pairs(builder)),
+                                    builders))
+        for (builder, builder_pairs) in zip(builders, pairs):
+            for (rev, b) in builder_pairs:
+                builds = self.revs.setdefault(rev, {})
+
+                # the first real result per builder wins; select=-1 is asked for first
                 if "results" in b and (not build_has_status(b, BUILDBOT_STATUS_RETRY)):
-                    if builder not in self.revs[rev]:
-                        self.revs[rev][builder] = b
+                    builds.setdefault(builder, b)
 
     def rev_build_pairs(self, builder):
         u = "%s/json/builders/%s/builds?%s" % \
             (self.url, builder,
              "&".join(["select=%d" % x
                        for x in range(-1, -(self.nbuilds+1), -1)]))
-        self.log.info("fetching " + u)
-        j = json.load(urllib.request.urlopen(u, timeout=TIMEOUT))
+        return self.fetch_json(u, lambda j: list(self.build_revs(j)))
+
+    # The root json resource can select builds of every builder at once,
+    # e.g. ?select=builders/linux/builds/-1, which saves a request per
+    # builder. Returns None if this buildbot won't answer that way.
+    def batched_rev_build_pairs(self, builders):
+        u = "%s/json?%s" % \
+            (self.url,
+             "&".join(["select=builders/%s/builds/%d" % (builder, x)
+                       for builder in builders
+                       for x in range(-1, -(self.nbuilds+1), -1)]))
+        try:
+            return self.fetch_json(u, lambda j:
+                                   [ list(self.build_revs(j["builders"][builder]["builds"]))
+                                     for builder in builders ])
+        except (urllib.error.URLError, ValueError, KeyError, TypeError):
+            self.log.info("batched fetch failed, falling back to one per builder")
+            self.batch_failed = True
+            return None
+
+    # Fetches u and returns digest() of its json, or what digest() made of
+    # it last run if the server says it hasn't changed since. Retries
+    # server errors and dropped connections with exponential backoff;
+    # anything else (e.g. a 404 for a misnamed builder) is final.
+    def fetch_json(self, u, digest):
+        (etag, modified, cached) = self.old_cache.get(u, (None, None, None))
+        req = urllib.request.Request(u)
+        if etag is not None:
+            req.add_header("If-None-Match", etag)
+        if modified is not None:
+            req.add_header("If-Modified-Since", modified)
+        delay = 1
+        for attempt in range(BUILDBOT_TRIES):
+            self.log.info("fetching %s", u)
+            try:
+                with urllib.request.urlopen(req, timeout=TIMEOUT) as r:
+                    d = digest(json_loads(r.read()))
+                    if r.headers.get("ETag") or r.headers.get("Last-Modified"):
+                        self.cache[u] = [r.headers.get("ETag"),
+                                         r.headers.get("Last-Modified"), d]
+                    return d
+            except urllib.error.HTTPError as e:
+                if e.code == 304 and cached is not None:
+                    self.log.info("%s unchanged since last run", u)
+                    self.cache[u] = [etag, modified, cached]
+                    return cached
+                if e.code < 500 or attempt == BUILDBOT_TRIES - 1:
+                    raise
+                self.log.info("fetching %s failed (%s), retrying in %ds", u, e, delay)
+            except (urllib.error.URLError, OSError) as e:
+                if attempt == BUILDBOT_TRIES - 1:
+                    raise
+                self.log.info("fetching %s failed (%s), retrying in %ds", u, e, delay)
+            time.sleep(delay)
+            delay *= 2
+
+    def build_revs(self, j):
         for build in j:
             b = j[build]
             rev = None
@@ -160,7 +257,10 @@ class BuildBot:
                 if props[0] == "got_revision" and props[2] in ("Source", "Git", "SetProperty Step"):
                     rev = props[1]
             if rev is not None:
-                yield (rev, b)
+                # Builds carry their steps, logs and full property lists;
+                # keep only what test_status() reads so each response can
+                # be freed as soon as it's scanned.
+                yield (rev, { k: b[k] for k in ("number", "results") if k in b })
 
     # returns a pair: a tri-state (False=failure, True=pass, None=waiting)
     # coupled with two lists of URLs to post back as status-details. When
@@ -169,6 +269,22 @@ class BuildBot:
     # second is the exceptions.
     def test_status(self, sha):
 
+        if self.revs is None:
+            self.revs = {}
+
+        known = self.old_results.get(sha, {})
+        wanted = [ builder for builder in self.builders
+                   if builder not in known and builder not in self.fetched ]
+        if wanted:
+            self.get_status(wanted)
+        else:
+            self.log.info("all builders had finished %s already", sha)
+        for (builder, b) in known.items():
+            self.revs.setdefault(sha, {}).setdefault(builder, b)
+        self.results[sha] = { builder: b
+                              for (builder, b) in self.revs.get(sha, {}).items()
+                              if b.get("results") is not None }
+
         if sha in self.revs:
 
             passes = []
@@ -180,16 +296,16 @@ class BuildBot:
             for builder in self.builders:
 
                 if builder not in self.revs[sha]:
-                    self.log.info("missing info for builder %s on %s"
-                                  % (builder, sha))
+                    self.log.info("missing info for builder %s on %s",
+                                  builder, sha)
                     continue
 
-                self.log.info("checking results for %s on %s"
-                              % (builder, sha))
+                self.log.info("checking results for %s on %s",
+                              builder, sha)
                 b = self.revs[sha][builder]
                 if "results" in b:
-                    self.log.info("got results %s for %s on %s"
-                                  % (b["results"], builder, sha))
+                    self.log.info("got results %s for %s on %s",
+                                  b["results"], builder, sha)
                     u = ("%s/builders/%s/builds/%s" %
                          (self.url, builder, b["number"]))
                     if build_has_status(b, BUILDBOT_STATUS_SUCCESS):
@@ -211,7 +327,7 @@ class BuildBot:
                 return (None, [], [])
 
         else:
-            self.log.info("missing info sha %s" % sha)
+            self.log.info("missing info sha %s", sha)
             return (None, [], [])
 
 def ustr(s):
@@ -220,16 +336,28 @@ def ustr(s):
     else:
         return s
 
+PRIORITY_RE = re.compile(r"\bp=(-?\d+)\b")
+R_EQ_USER_RE = re.compile(r"^r=([a-zA-Z0-9_-]+)")
+R_EQ_USER_SHA_RE = re.compile(r"^r=([a-zA-Z0-9_-]+) ([a-z0-9]+)")
+MERGE_SHA_DESC_RE = re.compile(r"running tests for candidate ([a-z0-9]+)")
+
+def tokens_sha_re(tokens):
+    return re.compile(r"^(?:"+"|".join([re.escape(t) for t in tokens])+r")\s+([a-z0-9]{7,40})")
+
 class PullReq:
     def __init__(self, cfg, gh, j):
         self.cfg = cfg
         self.log = logging.getLogger("pullreq")
         self.user = cfg["gh_user"]
         self.target_ref = j["base"]["ref"]
-        self.reviewers = [ r for r in cfg["reviewers"] ]
-        self.approval_tokens = [ r for r in cfg["approval_tokens"] ]
-        self.disapproval_tokens = [ r for r in cfg["disapproval_tokens"] ]
-        self.ignored_users_in_comments = [ r for r in cfg.get("ignored_users_in_comments", []) ]
+        self.reviewers = cfg["reviewers"]
+        self.approval_tokens = tuple(cfg["approval_tokens"])
+        self.disapproval_tokens = tuple(cfg["disapproval_tokens"])
+        self.ignored_users_in_comments = cfg["ignored_users_in_comments"]
+        self.approval_re = tokens_sha_re(self.approval_tokens)
+        self.disapproval_re = tokens_sha_re(self.disapproval_tokens)
+        self.retry_prefix = "@" + self.user + ": retry"
+        self.merge_re = re.compile(r"^@"+re.escape(self.user)+":{0,1} merge")
         self.num=j["number"]
         self.gh_host=cfg.get("gh_host", "github.com")
         self.dst_owner=cfg["owner"]
@@ -246,8 +374,15 @@ class PullReq:
 
         self.title=ustr(j["title"])
         self.body=ustr(j["body"])
+        self.short_desc = ("%s/%s/%s = %.8s" %
+                           (self.src_owner, self.src_repo, self.ref, self.sha))
+        self.long_desc = ("pull https://%s/%s/%s/pull/%d - %s - '%.30s'" %
+                          (self.gh_host, self.dst_owner, self.dst_repo,
+                           self.num, self.short_desc, self.title))
         self.merge_sha = None
         self.closed=j["state"] == "closed"
+        # bumped by github on every pull or issue comment (among others)
+        self.updated_at = j.get("updated_at")
         self.approved = False
         self.testpass = False
         self.gh = gh
@@ -259,22 +394,65 @@ class PullReq:
 
         self.pull_comments = []
         self.head_comments = []
-        self.get_pull_comments()
-        self.get_head_comments()
+        self.statuses = []
+        self.pending_descs = []
+        self.status_counts = collections.Counter()
+        # Set when the pull comments and mergeability came along with the
+        # pull list (see load_pulls_graphql) and needn't be fetched again.
+        self.prefetched = False
+        # Likewise for the reviewers' comments on the head commit.
+        self.prefetched_head = False
+        # Likewise for the pull comments alone, when main() had them from
+        # last run and the pull hasn't been touched since.
+        self.prefetched_comments = False
+        self.loaded_ok = False
+        # Nothing these depend on changes once we've loaded, and main()
+        # asks for each of them several times per pull.
+        self.cached_state = None
+        self.cached_comments = None
+        self.cached_approvals = None
+        self.cached_retries = None
+        # what scan_head_comments() finds
+        self.head_approvals = []
+        self.head_r_eq = []
+        self.head_r_eq_sha = []
+        self.head_disapprovals = []
+        self.head_priority = 0
+        self.head_retries = 0
+
+    # Issues all the GETs needed to evaluate current_state(). Kept out of
+    # __init__ so main() can run it for many pulls concurrently; it only
+    # reads from github, so there's no ordering to preserve between pulls.
+    def load(self):
+        if self.closed:
+            # current_state() doesn't look any further than this
+            self.loaded_ok = True
+            return
+        if not (self.prefetched or self.prefetched_comments):
+            self.get_pull_comments()
+        if not self.prefetched_head:
+            self.get_head_comments()
+        self.scan_head_comments()
         self.get_head_statuses()
-        self.get_mergeable()
-        self.get_merge_sha()
+        # Mergeability can only make a pull STALE, and a pull that has
+        # already failed out or passed its tests is past caring. With
+        # mergeable_only_when_approved, so is one nobody has approved yet:
+        # for those STALE only changes what the status page says.
+        past_caring = (STATE_BAD, STATE_TESTED)
+        if self.cfg.get("mergeable_only_when_approved"):
+            past_caring += (STATE_UNREVIEWED, STATE_DISCUSSING)
+        if (not self.prefetched and
+            self.compute_state() not in past_caring):
+            self.get_mergeable()
         self.loaded_ok = True
 
-
+    # Both of these end up in most log lines, and nothing they're built
+    # from changes after __init__.
     def short(self):
-        return ("%s/%s/%s = %.8s" %
-                (self.src_owner, self.src_repo, self.ref, self.sha))
+        return self.short_desc
 
     def desc(self):
-        return ("pull https://%s/%s/%s/pull/%d - %s - '%.30s'" %
-                (self.gh_host, self.dst_owner, self.dst_repo,
-                 self.num, self.short(), self.title))
+        return self.long_desc
 
     def src(self):
         return self.gh.repos(self.src_owner)(self.src_repo)
@@ -296,20 +474,32 @@ class PullReq:
     def get_head_comments(self):
         logging.info("loading head comments on %s", self.short())
         cs = self.src().commits(self.sha).comments().get()
+        reviewers = self.reviewers
         self.head_comments = [
             (c["created_at"],
              c["user"]["login"],
              ustr(c["body"]))
             for c in cs
-            if c["user"]["login"] in self.reviewers and
+            if c["user"]["login"] in reviewers and
                 # don't allow edited comments because the owner of the fork can edit them
                 c["created_at"] == c["updated_at"]
             ]
 
+    # These are all asked for several times per run (by current_state(),
+    # try_advance() and the status dump) and the comments don't change
+    # once loaded, so work each out once.
     def all_comments(self):
-        a = self.head_comments + self.pull_comments
-        a = sorted(a, key=lambda c: c[0])
-        a = [c for c in a if c[1] not in self.ignored_users_in_comments]
+        if self.cached_comments is None:
+            self.cached_comments = self.compute_comments()
+        return self.cached_comments
+
+    def compute_comments(self):
+        # Timestamps are all github's fixed-width ISO 8601, which sort as
+        # strings just as they would as times.
+        ignored = self.ignored_users_in_comments
+        a = [c for c in self.head_comments + self.pull_comments
+             if c[1] not in ignored]
+        a.sort(key=itemgetter(0))
         return a
 
     def last_comment(self):
@@ -320,34 +510,53 @@ class PullReq:
             return ("","","")
 
     def approval_list(self):
-        rec = re.compile(r"^(?:"+"|".join([re.escape(t) for t in self.approval_tokens])+")\s+([a-z0-9]{7,40})")
+        if self.cached_approvals is None:
+            self.cached_approvals = self.compute_approvals()
+        return self.cached_approvals
+
+    # approval_list(), disapproval_list(), priority() and count_retries()
+    # all want something from the head comments; walk them once for all.
+    def scan_head_comments(self):
+        approval_tokens = self.approval_tokens
+        disapproval_tokens = self.disapproval_tokens
+        retry = self.retry_prefix
+        for (d,u,c) in self.head_comments:
+            # check for approval tokens on the commit comments
+            if c.startswith(approval_tokens):
+                self.head_approvals.append(u)
+            # check for disapproval tokens on the commit comments
+            if c.startswith(disapproval_tokens):
+                self.head_disapprovals.append(u)
+            # check for the r=<user> syntax on the commit comment
+            m = R_EQ_USER_RE.match(c)
+            if m:
+                self.head_r_eq.append(m.group(1))
+            # check for the r=<name> followed by the branch SHA
+            m = R_EQ_USER_SHA_RE.match(c)
+            if m and u in self.reviewers and self.sha.startswith(m.group(2)):
+                self.head_r_eq_sha.append(m.group(1))
+            m = PRIORITY_RE.search(c)
+            if m is not None:
+                self.head_priority = max(self.head_priority, int(m.group(1)))
+            if c.startswith(retry):
+                self.head_retries += 1
+
+    def compute_approvals(self):
+        rec = self.approval_re
         return (
-                # check for approval tokens on the commit comments
-                [u for (d,u,c) in self.head_comments
-                    if any([c.startswith(token) for token in self.approval_tokens])]
-                 +
-                # check for the r=<user> syntax on the commit comment
-                [ m.group(1)
-                  for (_,_,c) in self.head_comments
-                  for m in [re.match(r"^r=([a-zA-Z0-9_-]+)", c)] if m ]
+                self.head_approvals
+                +
+                self.head_r_eq
                 +
                 # check for the approval tokens followed by the branch SHA in the PR comments from reviewers
                 [ u
                   for (_,u,c) in self.pull_comments
-                  for m in [re.match(rec, c)] if m and u in self.reviewers and self.sha.startswith(m.group(1)) ]
+                  for m in [rec.match(c)] if m and u in self.reviewers and self.sha.startswith(m.group(1)) ]
                 +
-                # check for the r=<name> followed by the branch SHA in the PR comments from reviewers
-                [ m.group(1)
-                  for (_,_,c) in self.head_comments
-                  for m in [re.match(r"^r=([a-zA-Z0-9_-]+) ([a-z0-9]+)", c)] if m and u in self.reviewers and self.sha.startswith(m.group(2)) ])
+                self.head_r_eq_sha)
 
     def priority(self):
-        p = 0
-        for (d, u, c) in self.head_comments:
-            m = re.search(r"\bp=(-?\d+)\b", c)
-            if m is not None:
-                p = max(p, int(m.group(1)))
-        return p
+        return self.head_priority
 
     def prioritized_state(self):
         return (self.current_state(),
@@ -355,22 +564,26 @@ class PullReq:
                 -self.num)
 
     def disapproval_list(self):
-        rec = re.compile(r"^(?:"+"|".join([re.escape(t) for t in self.disapproval_tokens])+")\s+([a-z0-9]{7,40})")
+        rec = self.disapproval_re
         return (
-                # check for disapproval tokens on the commit comments
-                [u for (d,u,c) in self.head_comments
-                    if any([c.startswith(token) for token in self.disapproval_tokens])]
+                self.head_disapprovals
                 +
                 # check for disapproval tokens followed by the branch SHA in the PR comments from reviewers
                 [ u
                     for (_,u,c) in self.pull_comments
-                    for m in [re.match(rec, c)] if m and u in self.reviewers and self.sha.startswith(m.group(1)) ])
+                    for m in [rec.match(c)] if m and u in self.reviewers and self.sha.startswith(m.group(1)) ])
 
     def count_retries(self):
-        r = ( len([c for (d,u,c) in self.head_comments if (
-                     c.startswith("@"+self.user+": retry"))])
-                + len([c for (d,u,c) in self.pull_comments if (
-                     c.startswith("@"+self.user+": retry") and u in self.reviewers)]))
+        if self.cached_retries is None:
+            self.cached_retries = self.compute_retries()
+        return self.cached_retries
+
+    def compute_retries(self):
+        retry = self.retry_prefix
+        reviewers = self.reviewers
+        r = ( self.head_retries
+                + sum(1 for (d,u,c) in self.pull_comments if (
+                     c.startswith(retry) and u in reviewers)))
         return r
 
     # annoyingly, even though we're starting from a "pull" json
@@ -393,14 +606,25 @@ class PullReq:
     def get_head_statuses(self):
         ss = self.dst().statuses(self.sha).get()
         logging.info("loading statuses of %s", self.short())
-        self.statuses = [ s["state"]
-                          for s in ss
-                          if s["creator"]["login"] == self.user]
+        user = self.user
+        ours = [ s for s in ss if s["creator"]["login"] == user ]
+        self.statuses = [ s["state"] for s in ours ]
+        # kept for get_merge_sha(), newest first
+        self.pending_descs = [ s["description"] for s in ours
+                               if s["state"] == "pending" ]
+        self.status_counts = collections.Counter(self.statuses)
 
     def set_status(self, s, **kwargs):
         self.log.info("%s - setting status: %s (%s)",
-                      self.short(), s, str(kwargs))
+                      self.short(), s, kwargs)
         self.dst().statuses(self.sha).post(state=s, **kwargs)
+        # Keep what load() saw in step with github, so the status dump at
+        # the end of the run shows where this pull has got to.
+        self.statuses.insert(0, s)
+        self.status_counts[s] += 1
+        if s == "pending":
+            self.pending_descs.insert(0, kwargs["description"])
+        self.cached_state = None
 
     def set_pending(self, txt, url):
         self.set_status("pending", description=txt, target_url=url)
@@ -415,24 +639,24 @@ class PullReq:
         self.set_status("error", description=txt)
 
     def count_failures(self):
-        return len([c for c in self.statuses if c == "failure"])
+        return self.status_counts["failure"]
 
     def count_successes(self):
-        return len([c for c in self.statuses if c == "success"])
+        return self.status_counts["success"]
 
     def count_pendings(self):
-        return len([c for c in self.statuses if c == "pending"])
+        return self.status_counts["pending"]
 
     def count_errors(self):
-        return len([c for c in self.statuses if c == "error"])
+        return self.status_counts["error"]
 
     def merge_allowed(self):
         if self.cfg.get('no_auto_merge') is True:
             # bors is configured to wait for the PR author to approve the merge
-            rec = re.compile(r"^@"+re.escape(self.user)+":{0,1} merge")
+            rec = self.merge_re
             merges = [ u
                     for (_,u,c) in self.pull_comments
-                    for m in [re.match(rec, c)] if m and u in self.reviewers ]
+                    for m in [rec.match(c)] if m and u in self.reviewers ]
             return len(merges) > 0
         return True
 
@@ -449,22 +673,24 @@ class PullReq:
             try:
                 self.dst().git().refs().heads(self.ref).delete()
             except github.ApiError:
-                self.log.info("deleting source branch %s failed" % self.test_ref)
+                self.log.info("deleting source branch %s failed", self.test_ref)
 
     def get_merge_sha(self):
-        # Find the newest 'pending' status and parse the SHA out of that
-        ss = self.dst().statuses(self.sha).get()
-        logging.info("loading statuses of %s", self.short())
-        statusdescs = [ s["description"]
-                          for s in ss
-                          if s["creator"]["login"] == self.user and s["state"] == "pending"]
+        # Find the newest 'pending' status and parse the SHA out of that;
+        # get_head_statuses() already loaded them
+        statusdescs = self.pending_descs
         if len(statusdescs) > 0:
             # parse it
-            m = re.match(r"running tests for candidate ([a-z0-9]+)", statusdescs[0])
+            m = MERGE_SHA_DESC_RE.match(statusdescs[0])
             if m:
                 self.merge_sha = m.group(1)
 
     def current_state(self):
+        if self.cached_state is None:
+            self.cached_state = self.compute_state()
+        return self.cached_state
+
+    def compute_state(self):
 
         if self.closed:
             return STATE_CLOSED
@@ -537,15 +763,20 @@ class PullReq:
             self.log.info(s)
             self.add_comment(self.sha, s)
             self.set_pending("running tests for candidate %s" % self.merge_sha, u)
+            return True
 
         except github.ApiError:
             s = s + " failed"
             self.log.info(s)
             self.add_comment(self.sha, s)
             self.set_error(s)
+            return False
 
     def advance_target_ref_to_test(self):
-        assert self.merge_sha is not None
+        if self.merge_sha is None:
+            self.log.info("%s - no merge sha to fast-forward %s to",
+                          self.short(), self.target_ref)
+            return
         s = ("fast-forwarding %s to %s = %.8s" %
              (self.target_ref, self.test_ref, self.merge_sha))
         self.log.info(s)
@@ -558,9 +789,12 @@ class PullReq:
             try:
                 self.dst().git().refs().heads(self.test_ref).delete()
             except github.ApiError:
-                self.log.info("deleting integration branch %s failed" % self.test_ref)
+                self.log.info("deleting integration branch %s failed", self.test_ref)
 
             self.maybe_delete_source_branch()
+            # github closes the pull itself once its head is on the target
+            self.closed = True
+            self.cached_state = None
 
         except github.ApiError:
             s = s + " failed"
@@ -568,26 +802,84 @@ class PullReq:
             self.add_comment(self.sha, s)
             self.set_error(s)
 
-    def fresh(self):
-        # NOTE: only call this when needed,
-        # as the result may change as other
+    def load_candidate(self, merge_sha=None):
+        # The test candidate (merge_sha, or else whatever test_ref points
+        # at), the current head of the merge-target and the candidate's
+        # parents: everything fresh() looks at. Over GraphQL that's one
+        # request rather than three.
+        owner = self.cfg["owner"]
+        repo = self.cfg["repo"]
+        if self.cfg.get("use_graphql"):
+            candidate = merge_sha or "refs/heads/" + self.test_ref
+            r = self.gh.graphql(CANDIDATE_QUERY, owner=owner, repo=repo,
+                                target="refs/heads/" + self.target_ref,
+                                candidate=candidate)["repository"]
+            if r["target"] is None or r["candidate"] is None:
+                raise github.ApiNotFoundError(candidate, None, None)
+            test_parents = [ x["oid"] for x in r["candidate"]["parents"]["nodes"] ]
+            return (r["candidate"]["oid"], r["target"]["oid"], test_parents)
+
+        if merge_sha is None:
+            test_head = self.gh.repos(owner)(repo).git().refs().heads(self.test_ref).get()
+            merge_sha = test_head["object"]["sha"]
+        target_head = self.gh.repos(owner)(repo).git().refs().heads(self.target_ref).get()
+        target_sha = target_head["object"]["sha"]
+        test_commit = self.gh.repos(owner)(repo).git().commits(merge_sha).get()
+        test_parents = [ x["sha"] for x in test_commit["parents"] ]
+        return (merge_sha, target_sha, test_parents)
+
+    def fresh(self, target_sha, test_parents):
+        # NOTE: only load target_sha and test_parents
+        # when needed, as they may change as other
         # PRs are advanced
 
         # a PR is fresh if the two
         # parents of the merge sha are
         # the tip of the merge-target and the
         # feature branch
-        owner = self.cfg["owner"]
-        repo = self.cfg["repo"]
-        target_head = self.gh.repos(owner)(repo).git().refs().heads(self.target_ref).get()
-        target_sha = target_head["object"]["sha"]
-        test_commit = self.gh.repos(owner)(repo).git().commits(self.merge_sha).get()
-        test_parents = [ x["sha"] for x in test_commit["parents"] ]
         return (len(test_parents) == 2 and
                 target_sha in test_parents and
                 self.sha in test_parents)
 
-    def try_advance(self):
+    # Sort the candidate's check runs (or commit statuses) by state in one
+    # pass. Both are paged, and we stop asking for more as soon as anything
+    # has failed: the candidate can't pass after that.
+    def check_runs_by_state(self):
+        runs = collections.defaultdict(list)
+        page = 1
+        while True:
+            js = self.dst().commits(self.merge_sha, "check-runs").get(per_page=CHECKS_PER_PAGE,
+                                                                      page=page).check_runs
+            self.log.info("USING %d commit status for commit: %s", len(js), self.merge_sha)
+            for r in js:
+                if r["status"] != "completed":
+                    runs["pending"].append(r)
+                elif r["conclusion"] in ("success", "failure"):
+                    runs[r["conclusion"]].append(r)
+                else:
+                    # consider any other completion code as error
+                    runs["error"].append(r)
+            if runs["failure"] or runs["error"] or len(js) < CHECKS_PER_PAGE:
+                return runs
+            page += 1
+
+    def commit_statuses_by_state(self):
+        statuses = collections.defaultdict(list)
+        page = 1
+        while True:
+            js = self.dst().statuses(self.merge_sha).get(per_page=CHECKS_PER_PAGE,
+                                                         page=page)
+            self.log.info("found %d commit status for commit: %s", len(js), self.merge_sha)
+            for s in js:
+                statuses[s["state"]].append(s)
+            if statuses["failure"] or statuses["error"] or len(js) < CHECKS_PER_PAGE:
+                return statuses
+            page += 1
+
+    # Returns True if this pull now has test_ref to itself: a candidate
+    # is being tested, or has just passed and lands next run. Nothing
+    # else can be tested until that's over.
+    def try_advance(self, bb):
         s = self.current_state()
 
         self.log.info("considering %s", self.desc())
@@ -606,37 +898,30 @@ class PullReq:
                                               self.sha))))
 
             self.reset_test_ref_to_target()
-            self.merge_pull_head_to_test_ref()
+            return self.merge_pull_head_to_test_ref()
 
         elif s == STATE_PENDING:
             # Make sure the optional merge sha is loaded
-            owner = self.cfg["owner"]
-            repo = self.cfg["repo"]
-            test_head = self.gh.repos(owner)(repo).git().refs().heads(self.test_ref).get()
-            test_sha = test_head["object"]["sha"]
-            self.merge_sha = test_sha
+            (self.merge_sha, target_sha,
+             test_parents) = self.load_candidate()
 
-            if not self.fresh():
+            if not self.fresh(target_sha, test_parents):
                 c = ("Merge sha %.8s is stale."
                      % (self.merge_sha,))
                 self.log.info(c)
                 self.add_comment(self.sha, c)
                 self.reset_test_ref_to_target()
-                self.merge_pull_head_to_test_ref()
-                return
+                return self.merge_pull_head_to_test_ref()
             self.log.info("%s - found pending state, checking tests", self.short())
-            assert self.merge_sha is not None
             if self.cfg.get("use_github_checks_api"):
-                statuses = self.dst().commits(self.merge_sha,"check-runs").get().check_runs
-                self.log.info("USING %d commit status for commit: %s" % (len(statuses), self.merge_sha))
-                pending = [s for s in statuses if s["status"] != "completed"]
-                successes = [s for s in statuses if s["status"] == "completed" and s["conclusion"] == "success"]
-                failures = [s for s in statuses if s["status"] == "completed" and s["conclusion"] == "failure"]
-                # consider any other completion code as error
-                errors = [s for s in statuses if s["status"] == "completed" and not ( s["conclusion"] == "failure" or s["conclusion"] == "success") ]
-                self.log.info("%d pending %d sucesses %d failure %d error" % (len(pending), len(successes), len(failures), len(errors)))
-
-                if len(successes) > 0 and len(statuses) == len(successes):
+                runs = self.check_runs_by_state()
+                pending = runs["pending"]
+                successes = runs["success"]
+                failures = runs["failure"]
+                errors = runs["error"]
+                self.log.info("%d pending %d sucesses %d failure %d error", len(pending), len(successes), len(failures), len(errors))
+
+                if len(successes) > 0 and len(pending) + len(failures) + len(errors) == 0:
                     t = True
                     main_urls = [s["html_url"] for s in successes]
                     extra_urls = []
@@ -651,14 +936,13 @@ class PullReq:
                     extra_urls = []
 
             elif self.cfg.get("use_github_commit_status_api"):
-                statuses = self.dst().statuses(self.merge_sha).get()
-                self.log.info("found %d commit status for commit: %s" % (len(statuses), self.merge_sha))
-                pending = [s for s in statuses if s["state"] == "pending"]
-                successes = [s for s in statuses if s["state"] == "success"]
-                failures = [s for s in statuses if s["state"] == "failure"]
-                errors = [s for s in statuses if s["state"] == "error"]
-                self.log.info("%d pending %d sucesses %d failure %d error" % (len(pending), len(successes), len(failures), len(errors)))
-                if len(statuses) == 0 or (len(successes) + len(failures) + len(errors)) == 0:
+                statuses = self.commit_statuses_by_state()
+                pending = statuses["pending"]
+                successes = statuses["success"]
+                failures = statuses["failure"]
+                errors = statuses["error"]
+                self.log.info("%d pending %d sucesses %d failure %d error", len(pending), len(successes), len(failures), len(errors))
+                if (len(successes) + len(failures) + len(errors)) == 0:
                     t = None
                     main_urls = []
                     extra_urls = []
@@ -671,7 +955,6 @@ class PullReq:
                     main_urls = [s["target_url"] for s in failures]
                     extra_urls = [s["target_url"] for s in errors]
             else:
-                bb = BuildBot(self.cfg)
                 (t, main_urls, extra_urls) = bb.test_status(self.merge_sha)
 
             if t is True:
@@ -684,6 +967,7 @@ class PullReq:
                 c += "\n"
                 self.add_comment(self.sha, c)
                 self.set_success("all tests passed", url)
+                return True
 
             elif t is False:
                 self.log.info("%s - tests failed, marking failure", self.short())
@@ -698,13 +982,26 @@ class PullReq:
 
             else:
                 self.log.info("%s - no info yet, waiting on tests", self.short())
+                return True
 
         elif s == STATE_TESTED:
+            # Only the pulls we're about to land need to know what they
+            # were tested as, so this isn't part of load().
+            self.get_merge_sha()
             if not self.merge_allowed():
+                # landing checks the merge sha against the target with
+                # fresh(), so this needn't hold anything up meanwhile
                 self.log.info("%s - tests successful, waiting for merge approval",
                         self.short())
-                return
-            if self.fresh():
+                return False
+            if self.merge_sha is None:
+                # no pending status of ours names the candidate that was
+                # tested, so there's nothing we can safely land
+                self.log.info("%s - tests successful, but can't tell what merge sha "
+                              "was tested, skipping", self.short())
+                return False
+            (_, target_sha, test_parents) = self.load_candidate(self.merge_sha)
+            if self.fresh(target_sha, test_parents):
                 self.log.info("%s - tests successful, attempting landing", self.short())
                 self.advance_target_ref_to_test()
             else:
@@ -713,9 +1010,279 @@ class PullReq:
                 self.log.info(c)
                 self.add_comment(self.sha, c)
                 self.reset_test_ref_to_target()
-                self.merge_pull_head_to_test_ref()
+                return self.merge_pull_head_to_test_ref()
+
+        return False
 
 
+PULLS_PER_PAGE = 100
+
+# Both of these yield the open pulls a page at a time, so their loads can
+# get going while the next page is on its way.
+#
+# With skip_draft_pulls set, drafts are left out before anything is
+# loaded for them: they're not ready to land, and on a busy repo they
+# can be a fair share of the open pulls.
+def load_pulls_rest(cfg, gh):
+    owner = cfg["owner"]
+    repo = cfg["repo"]
+    skip_drafts = cfg.get("skip_draft_pulls")
+    page = 1
+    while True:
+        # github only returns the first 30 unless asked for more; pages
+        # come back full until the last one
+        logging.info("loading page %d of pull reqs of %s/%s", page, owner, repo)
+        js = gh.repos(owner)(repo).pulls().get(state="open",
+                                               per_page=PULLS_PER_PAGE,
+                                               page=page)
+        yield [ PullReq(cfg, gh, j) for j in js
+                if not (skip_drafts and j.get("draft")) ]
+        if len(js) < PULLS_PER_PAGE:
+            return
+        page += 1
+
+# Collaborators are paged like pulls; each page is revalidated with its
+# ETag, so an unchanged list costs nothing against the rate limit.
+def load_reviewers(cfg, gh):
+    owner = cfg["owner"]
+    repo = cfg["repo"]
+    reviewers = []
+    page = 1
+    while True:
+        js = gh.repos(owner)(repo).collaborators().get(per_page=PULLS_PER_PAGE,
+                                                       page=page)
+        reviewers += [ c["login"] for c in js ]
+        if len(js) < PULLS_PER_PAGE:
+            logging.info("found %d collaborators", len(reviewers))
+            return reviewers
+        page += 1
+
+# Everything about a pull that's the same for every reader: its place in
+# the repo, its pull and issue comments, and github's idea of whether it
+# merges cleanly. Statuses and head comments are still fetched over REST:
+# graphql only exposes the latest status per context, and we count the
+# full history against retries.
+PULLS_QUERY = '''
+query($owner: String!, $repo: String!, $cursor: String) {
+  repository(owner: $owner, name: $repo) {
+    pullRequests(states: OPEN, first: 50, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number title body mergeable isDraft
+        baseRefName headRefName headRefOid
+        headRepository { name owner { login } }
+        headRef {
+          target {
+            oid
+            ... on Commit {
+              comments(last: 100) {
+                pageInfo { hasPreviousPage }
+                nodes { createdAt lastEditedAt author { login } body }
+              }
+            }
+          }
+        }
+        comments(last: 100) {
+          pageInfo { hasPreviousPage }
+          nodes { createdAt author { login } body }
+        }
+        reviewThreads(last: 50) {
+          pageInfo { hasPreviousPage }
+          nodes {
+            comments(first: 50) {
+              pageInfo { hasNextPage }
+              nodes { createdAt author { login } body }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+# object(expression:) takes a qualified ref name or a sha alike
+CANDIDATE_QUERY = '''
+query($owner: String!, $repo: String!, $target: String!, $candidate: String!) {
+  repository(owner: $owner, name: $repo) {
+    target: object(expression: $target) { oid }
+    candidate: object(expression: $candidate) {
+      oid
+      ... on Commit { parents(first: 3) { nodes { oid } } }
+    }
+  }
+}
+'''
+
+GRAPHQL_MERGEABLE = { "MERGEABLE": True, "CONFLICTING": False }
+
+def graphql_comment(c):
+    # deleted accounts come back as a null author; REST calls them "ghost"
+    login = c["author"]["login"] if c["author"] else "ghost"
+    return (c["createdAt"], login, ustr(c["body"]))
+
+def load_pulls_graphql(cfg, gh):
+    owner = cfg["owner"]
+    repo = cfg["repo"]
+    skip_drafts = cfg.get("skip_draft_pulls")
+    cursor = None
+    while True:
+        logging.info("loading pull reqs of %s/%s over graphql", owner, repo)
+        prs = gh.graphql(PULLS_QUERY, owner=owner, repo=repo,
+                         cursor=cursor)["repository"]["pullRequests"]
+        pulls = []
+        for n in prs["nodes"]:
+            if skip_drafts and n["isDraft"]:
+                continue
+            head_repo = n["headRepository"]
+            j = { "number": n["number"],
+                  "title": n["title"],
+                  "body": n["body"],
+                  "state": "open",
+                  "base": { "ref": n["baseRefName"] },
+                  "head": { "ref": n["headRefName"],
+                            "sha": n["headRefOid"],
+                            "repo": head_repo and
+                                    { "name": head_repo["name"],
+                                      "owner": head_repo["owner"] } } }
+            p = PullReq(cfg, gh, j)
+            threads = n["reviewThreads"]
+            # A pull with more comments than one query returns is loaded
+            # over REST instead, so we never miss an r+ or r- on it.
+            if not (n["comments"]["pageInfo"]["hasPreviousPage"] or
+                    threads["pageInfo"]["hasPreviousPage"] or
+                    any(t["comments"]["pageInfo"]["hasNextPage"]
+                        for t in threads["nodes"])):
+                p.pull_comments = (
+                    [ graphql_comment(c)
+                      for t in threads["nodes"]
+                      for c in t["comments"]["nodes"] ]
+                    + [ graphql_comment(c)
+                        for c in n["comments"]["nodes"] ])
+                p.mergeable = GRAPHQL_MERGEABLE.get(n["mergeable"])
+                p.prefetched = True
+            head = n["headRef"] and n["headRef"]["target"]
+            if (head and head["oid"] == p.sha and
+                not head["comments"]["pageInfo"]["hasPreviousPage"]):
+                # same filter as get_head_comments()
+                p.head_comments = [ graphql_comment(c)
+                                    for c in head["comments"]["nodes"]
+                                    if c["author"] and
+                                        c["author"]["login"] in p.reviewers and
+                                        c["lastEditedAt"] is None ]
+                p.prefetched_head = True
+            pulls.append(p)
+        yield pulls
+        if not prs["pageInfo"]["hasNextPage"]:
+            return
+        cursor = prs["pageInfo"]["endCursor"]
+
+# Each repo's pulls are kept in their own file under bors-status/, so a
+# run only reads and rewrites its own repo's. The all-repos
+# bors-status.json and bors-status.js the status page loads are spliced
+# together from those files as text, without parsing the others.
+STATUS_DIR = "bors-status"
+
+# Write to a temporary file and rename it into place, so a run that dies
+# part-way leaves the old file rather than a truncated one. The pid and
+# thread keep runs for different repos from sharing a temporary.
+def write_atomically(path, data):
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def status_path(repo):
+    return os.path.join(STATUS_DIR, "%s.json" % repo)
+
+# Repos run concurrently within a process (see main()); take turns, so
+# each splice sees every other repo's latest file, and only one of them
+# splits up an old bors-status.json.
+STATUS_LOCK = threading.Lock()
+
+def load_status(repo):
+    with STATUS_LOCK:
+        if not os.path.isdir(STATUS_DIR):
+            # split up the single all-repos file older versions kept
+            os.makedirs(STATUS_DIR, exist_ok=True)
+            try:
+                with open('bors-status.json', 'r') as f:
+                    old = json.load(f)
+            except (IOError, ValueError):
+                old = {}
+            for (r, pulls) in old.items():
+                write_atomically(status_path(r), json_dumps(pulls))
+    try:
+        with open(status_path(repo), 'rb') as f:
+            return json_loads(f.read())
+    except (IOError, ValueError):
+        return []
+
+# Most runs find nothing new, so the status files are only rewritten when
+# this repo's pulls look different from last run, or the combined files
+# are missing or older than its own. The time of the run is kept apart,
+# in the small bors-updated.js, so the page still shows bors is alive
+# without the rest being rewritten.
+def write_status(repo, pulls):
+    data = json_dumps(pulls)
+    with STATUS_LOCK:
+        write_atomically("bors-updated.js",
+                         strftime('var updated = new Date("%Y-%m-%dT%H:%M:%SZ");\n',
+                                  gmtime()).encode("ascii"))
+        try:
+            with open(status_path(repo), 'rb') as f:
+                unchanged = f.read() == data
+            # The combined files still need rebuilding if they've been
+            # removed, or a run died before getting round to them.
+            written = os.path.getmtime(status_path(repo))
+            unchanged = unchanged and all(os.path.getmtime(p) >= written
+                                          for p in ("bors-status.json",
+                                                    "bors-status.js"))
+        except IOError:
+            unchanged = False
+        if unchanged:
+            return
+        write_atomically(status_path(repo), data)
+
+        parts = []
+        for name in sorted(os.listdir(STATUS_DIR)):
+            if name.endswith(".json"):
+                with open(os.path.join(STATUS_DIR, name), 'rb') as f:
+                    parts.append(b"%s: %s" % (json_dumps(name[:-len(".json")]),
+                                              f.read()))
+        everything = b"{" + b", ".join(parts) + b"}"
+
+        write_atomically('bors-status.json', everything)
+
+        # Dump state-of-world javascript fragment
+        write_atomically("bors-status.js", b"var bors = " + everything + b";\n")
+
+WEBHOOK_MARKER = "bors-webhook-%s.dirty"
+WEBHOOK_SEEN = "bors-webhook-%s.seen"
+
+# With use_webhooks set, bors_webhook.py drops a marker for every github
+# event on a repo, and a run that finds none skips the repo without
+# touching the API. We still run while a pull is part-way to landing,
+# because buildbot results don't arrive as github events, and every
+# webhook_poll_interval seconds regardless in case an event went astray.
+#
+# A run moves the marker aside rather than deleting it, and run_repo()
+# only deletes it once the repo has been dealt with; a run that fails
+# leaves it for the next one to pick up.
+def webhook_wants_run(cfg, repo, run_state, last_pulls):
+    try:
+        # anything that arrives from here on re-creates it for next run
+        os.replace(WEBHOOK_MARKER % repo, WEBHOOK_SEEN % repo)
+        return True
+    except OSError:
+        pass
+    if os.path.exists(WEBHOOK_SEEN % repo):
+        return True
+    if any(p["state"] in ("APPROVED", "PENDING", "TESTED") for p in last_pulls):
+        return True
+    return (time.time() - run_state.get("polled", 0) >=
+            cfg.get("webhook_poll_interval", 900))
+
 
 def main():
 
@@ -743,7 +1310,8 @@ def main():
 
     logging.info("---------- starting run ----------")
     logging.info("loading bors.cfg")
-    cfg = json.load(open("bors.cfg"))
+    with open("bors.cfg", encoding="utf-8") as f:
+        cfg = json.load(f)
 
     if 'approval_tokens' not in cfg:
         cfg['approval_tokens'] = ['r+', 'r=me']
@@ -753,32 +1321,138 @@ def main():
 
     if args.repo:
         logging.info("using command line repo %s", args.repo)
-        cfg["repo"] = args.repo
-
-    gh = None
-    if "gh_pass" in cfg:
-        gh = github.GitHub(username=cfg["gh_user"],
-                           password=cfg["gh_pass"],
-                           api_url=cfg.get("gh_api"))
+        repos = [args.repo]
     else:
-        gh = github.GitHub(username=cfg["gh_user"],
-                           access_token=cfg["gh_token"],
-                           api_url=cfg.get("gh_api"))
+        # "repos" lists several of the owner's repos to handle in one run
+        repos = cfg.get("repos") or [cfg["repo"]]
+
+    # What we remember about each repo between runs: the ETags and bodies
+    # of last run's GETs, so unchanged listings come back as 304s that
+    # don't count against the rate limit, and when we last polled it.
+    try:
+        with open('bors-cache.json', 'r') as f:
+            run_db = json.load(f)
+    except (IOError, ValueError):
+        run_db = {}
+
+    # Repos share nothing but run_db, and each only touches its own entry,
+    # so they can all be worked on at once. One repo's failure doesn't
+    # stop the others, or lose what they saved in run_db; the first is
+    # re-raised once they're all done and the cache is written.
+    with ThreadPoolExecutor(max_workers=min(8, len(repos))) as ex:
+        runs = [ ex.submit(run_repo, dict(cfg, repo=repo), run_db)
+                 for repo in repos ]
+    failure = None
+    for (repo, r) in zip(repos, runs):
+        try:
+            r.result()
+        except Exception as e:
+            if failure is None:
+                failure = e
+            elif isinstance(e, github.ApiError):
+                logging.info("Github API exception on %s: %s", repo, e.response)
+            else:
+                logging.exception("exception on %s", repo)
 
+    write_atomically('bors-cache.json', json_dumps(run_db))
+    if failure is not None:
+        raise failure
 
+def run_repo(cfg, run_db):
     owner = cfg["owner"]
     repo = cfg["repo"]
 
+    run_state = run_db.setdefault(repo, {})
+
+    last_pulls = load_status(repo)
+
+    # If the last run left fewer than ratelimit_reserve API calls and
+    # github hasn't topped them up yet, sit this one out rather than spend
+    # what's left on a reload that can't get as far as doing anything.
+    (remaining, reset) = run_state.get("ratelimit", (None, 0))
+    reserve = cfg.get("ratelimit_reserve")
+    if (reserve and remaining is not None and remaining < reserve
+        and time.time() < reset):
+        logging.info("only %d github API calls left until %s, skipping run",
+                     remaining, strftime("%H:%M:%S", gmtime(reset)))
+        return
+
+    if (cfg.get("use_webhooks") and
+        not webhook_wants_run(cfg, repo, run_state, last_pulls)):
+        logging.info("no webhook events for %s since last run, nothing to do", repo)
+        return
+    run_state["polled"] = time.time()
+
+    if "gh_token" in cfg:
+        auth = { "access_token": cfg["gh_token"] }
+    else:
+        # github no longer takes account passwords over the API; a token
+        # given as gh_pass still works, but belongs in gh_token.
+        logging.warning("gh_pass is deprecated, put an access token in gh_token instead")
+        auth = { "password": cfg["gh_pass"] }
+    # With ratelimit_pace_below set, calls slow down once fewer than that
+    # many are left, instead of the run dying part-way on a 403.
+    gh = github.GitHub(username=cfg["gh_user"],
+                       api_url=cfg.get("gh_api"),
+                       etag_cache=run_state.get("etags"),
+                       ratelimit_pace_below=cfg.get("ratelimit_pace_below"),
+                       **auth)
+    try:
+        advance_repo(cfg, gh, run_state)
+    finally:
+        # Kept even when the run fails part-way, so that after running out
+        # of calls the next runs sit out the reset (see ratelimit_reserve)
+        # rather than failing the same way.
+        if gh.x_ratelimit_remaining >= 0:
+            run_state["ratelimit"] = [gh.x_ratelimit_remaining, gh.x_ratelimit_reset]
+
+    if cfg.get("use_webhooks"):
+        try:
+            os.remove(WEBHOOK_SEEN % repo)
+        except OSError:
+            pass
+
+def advance_repo(cfg, gh, run_state):
+    repo = cfg["repo"]
+
     if "collaborators_as_reviewers" in cfg and cfg["collaborators_as_reviewers"] is True:
-        # NOTE there is no paging when listing collaborators
-        collabs = gh.repos(owner)(repo).collaborators().get()
-        cfg["reviewers"] = [c["login"] for c in collabs]
-        logging.info("found %d collaborators", len(collabs))
+        reviewers = load_reviewers(cfg, gh)
+    else:
+        reviewers = cfg["reviewers"]
 
-    pulls = gh.repos(owner)(repo).pulls().get()
+    # Every PullReq looks users up in these; build the sets once per run.
+    cfg = dict(cfg,
+               reviewers=frozenset(reviewers),
+               ignored_users_in_comments=frozenset(cfg.get("ignored_users_in_comments", [])))
 
-    pulls = [ PullReq(cfg, gh, pull) for pull in
-              pulls ]
+    if cfg.get("use_graphql"):
+        pages = load_pulls_graphql(cfg, gh)
+    else:
+        pages = load_pulls_rest(cfg, gh)
+
+    # A pull whose updated_at hasn't moved has had no new comments, so
+    # last run's are still good and the two GETs for them can be skipped.
+    # Head comments and statuses don't touch updated_at; they're always
+    # asked for.
+    old_comments = run_state.get("pull_comments", {})
+
+    # Loading a pull is a handful of sequential GETs, so the wall time of a
+    # run is dominated by round-trips. Overlap them across pulls, and with
+    # fetching the rest of the list, but keep the pool small so we don't
+    # trip github's secondary rate limits.
+    pulls = []
+    loads = []
+    with ThreadPoolExecutor(max_workers=cfg.get("max_concurrency", 5)) as ex:
+        for page in pages:
+            for p in page:
+                c = old_comments.get(str(p.num))
+                if not p.prefetched and c and c[0] == p.updated_at:
+                    p.pull_comments = [ tuple(x) for x in c[1] ]
+                    p.prefetched_comments = True
+                loads.append(ex.submit(p.load))
+            pulls += page
+        for l in loads:
+            l.result()
 
     #
     # We are reconstructing the relationship between three tree-states on the
@@ -831,45 +1505,10 @@ def main():
     pulls = sorted(pulls, key=PullReq.prioritized_state)
     logging.info("got %d open pull reqs", len(pulls))
 
-    # Dump state-of-world javascript fragment
+    all_pulls = pulls
 
-    try:
-        json_db = json.load(open('bors-status.json', 'r'))
-    except IOError:
-        json_db = {}
-
-    j = []
-    for pull in pulls:
-        j.append({ "num": pull.num,
-                   "title": pull.title,
-                   "body": pull.body,
-                   "prio": pull.priority(),
-                   "src_owner": pull.src_owner,
-                   "src_repo": pull.src_repo,
-                   "dst_owner": pull.dst_owner,
-                   "dst_repo": pull.dst_repo,
-                   "num_comments": len(pull.head_comments +
-                                       pull.pull_comments),
-                   "last_comment": pull.last_comment(),
-                   "approvals": pull.approval_list(),
-                   "ref": pull.ref,
-                   "sha": pull.sha,
-                   "state": state_name(pull.current_state()) })
-
-    json_db[repo] = j
-    json.dump(json_db, open('bors-status.json', 'w'))
-
-    f = open("bors-status.js", "w")
-    f.write(strftime('var updated = new Date("%Y-%m-%dT%H:%M:%SZ");\n',
-                     gmtime()))
-    f.write("var bors = ")
-    json.dump(json_db, f)
-    f.write(";\n")
-    f.close()
-
-
-    pulls = [p for p in pulls if (p.current_state() >= STATE_DISCUSSING
-                                  and p.current_state() < STATE_CLOSED) ]
+    pulls = [p for p in pulls
+             if STATE_DISCUSSING <= p.current_state() < STATE_CLOSED ]
 
     logging.info("got %d viable pull reqs", len(pulls))
     for pull in pulls:
@@ -883,7 +1522,57 @@ def main():
         logging.info("Only considering %d pull-requests this run", max_pulls_per_run)
         pulls = pulls[-max_pulls_per_run:]
 
-    [p.try_advance() for p in reversed(pulls)]
+    # One buildbot scrape serves every pending pull in the run.
+    bb = None
+    if not (cfg.get("use_github_checks_api") or
+            cfg.get("use_github_commit_status_api")):
+        bb = BuildBot(cfg, run_state.get("buildbot"),
+                      run_state.get("buildbot_results"),
+                      run_state.get("buildbot_batch_failed", False))
+
+    try:
+        # Ripest first. With a shared test_ref, once one of them holds it
+        # the rest would only knock its candidate off (or spend API calls
+        # finding they can't), so they wait for a later run. Without one,
+        # each pull has an integration branch of its own and they all go.
+        shared_test_ref = bool(cfg.get("test_ref"))
+        for p in reversed(pulls):
+            if p.try_advance(bb) and shared_test_ref:
+                break
+    finally:
+        # Written after advancing, so the dump shows this run's outcome
+        # rather than last run's, even if advancing fell over part-way.
+        # priority() is cached and set_status() keeps current_state() up to
+        # date, so this is just copying fields out of each pull.
+        status = [ { "num": pull.num,
+                     "title": pull.title,
+                     "body": pull.body,
+                     "prio": pull.priority(),
+                     "src_owner": pull.src_owner,
+                     "src_repo": pull.src_repo,
+                     "dst_owner": pull.dst_owner,
+                     "dst_repo": pull.dst_repo,
+                     "num_comments": (len(pull.head_comments) +
+                                      len(pull.pull_comments)),
+                     "last_comment": pull.last_comment(),
+                     "approvals": pull.approval_list(),
+                     "ref": pull.ref,
+                     "sha": pull.sha,
+                     "state": state_name(pull.current_state()) }
+                   for pull in all_pulls ]
+        write_status(repo, status)
+
+    # Only keep what this run asked for; anything else belongs to shas
+    # and pulls that have since moved on.
+    run_state["etags"] = gh.etag_cache
+    run_state["pull_comments"] = {
+        str(p.num): [p.updated_at, p.pull_comments]
+        for p in all_pulls
+        if p.updated_at and p.loaded_ok and not p.closed }
+    if bb is not None and bb.revs is not None:
+        run_state["buildbot"] = bb.cache
+        run_state["buildbot_results"] = bb.results
+        run_state["buildbot_batch_failed"] = bb.batch_failed
 
 if __name__ == "__main__":
     try:
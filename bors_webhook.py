@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Mozilla Foundation.
+#
+# Licensed under the Apache License, Version 2.0 <LICENSE-APACHE or
+# http://www.apache.org/licenses/LICENSE-2.0> or the MIT license
+# <LICENSE-MIT or http://opensource.org/licenses/MIT>, at your
+# option. This file may not be copied, modified, or distributed
+# except according to those terms.
+#
+# A github webhook receiver for bors. Left to itself, bors reloads every
+# pull from github on every cron tick whether or not anything happened.
+# Run this alongside it in the same workspace, add a webhook on the repo
+# (content type application/json, with a secret) pointing at it, and set
+# "use_webhooks": true in bors.cfg; ticks with nothing new to look at then
+# exit before touching the API.
+#
+# It reads these keys from bors.cfg:
+#
+#       "webhook_secret": "<the-secret-given-to-github>",
+#       "webhook_port": <port-to-listen-on, default 8000>
+
+import hashlib
+import hmac
+import json
+import logging
+import re
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import bors
+
+# Events that can change what bors would do next on a repo.
+EVENTS = ("pull_request",
+          "pull_request_review_comment",
+          "issue_comment",
+          "commit_comment",
+          "status",
+          "check_run",
+          "check_suite",
+          "push")
+
+REPO_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    secret = None
+
+    def reply(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        sig = "sha256=" + hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+        given = self.headers.get("X-Hub-Signature-256", "")
+        if not hmac.compare_digest(sig.encode("ascii"),
+                                   given.encode("utf-8", "replace")):
+            logging.warning("bad signature from %s", self.client_address[0])
+            return self.reply(403)
+
+        event = self.headers.get("X-GitHub-Event")
+        try:
+            repo = json.loads(body.decode("utf-8"))["repository"]["name"]
+        except (ValueError, KeyError, TypeError):
+            # "ping" and friends may carry no repository at all
+            return self.reply(204 if event not in EVENTS else 400)
+
+        if (event in EVENTS and REPO_NAME_RE.match(repo)
+            and not repo.startswith(".")):
+            logging.info("%s event for %s", event, repo)
+            open(bors.WEBHOOK_MARKER % repo, "a").close()
+        self.reply(204)
+
+    def log_message(self, fmt, *args):
+        logging.debug(fmt, *args)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    with open("bors.cfg", encoding="utf-8") as f:
+        cfg = json.load(f)
+    if not cfg.get("webhook_secret"):
+        raise SystemExit("bors.cfg has no webhook_secret; refusing to accept unsigned events")
+    WebhookHandler.secret = cfg["webhook_secret"].encode("utf-8")
+    port = cfg.get("webhook_port", 8000)
+    server = HTTPServer(("", port), WebhookHandler)
+    logging.info("listening for github webhooks on port %d", port)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
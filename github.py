@@ -51,22 +51,41 @@ __version__ = '1.1.1'
 try:
     # Python 2
     from urllib2 import build_opener, HTTPSHandler, Request, HTTPError
-    from urllib import quote as urlquote
-    from StringIO import StringIO
+    from urllib import quote as urlquote, unquote, getproxies, proxy_bypass
+    from urllib import urlencode as _urlencode
+    from urlparse import urljoin, urlsplit
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
     def bytes(string, encoding=None):
         return str(string)
+    def urlencode(query, quote_via=None):
+        return _urlencode(dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                               for k, v in query.items()))
 except:
     # Python 3
-    from urllib.request import build_opener, HTTPSHandler, HTTPError, Request
-    from urllib.parse import quote as urlquote
-    from io import StringIO
+    from urllib.request import build_opener, HTTPSHandler, HTTPError, Request, getproxies, proxy_bypass
+    from urllib.parse import quote as urlquote, unquote, urljoin, urlsplit, urlencode
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
 
-import re, os, time, hmac, base64, hashlib, urllib, mimetypes, json
-from collections import Iterable
-from datetime import datetime, timedelta, tzinfo
+import time, base64, json, select, threading, random
 
 TIMEOUT=60
 
+# longest we'll sleep between retries of a failed request, in seconds
+MAX_BACKOFF=30
+
+# how many times one request will wait out a rate limit; these waits are
+# github's say-so rather than failures, so they don't use up retries
+MAX_RATELIMIT_WAITS=3
+
+# longest rate limit we'll wait out, in seconds; past that the request
+# fails, rather than a run sleeping for most of an hour while the next
+# ones pile up behind it
+MAX_RATELIMIT_WAIT=60
+
+# errors that will come back the same however often the request is sent
+# (bad request, bad credentials, forbidden, conflict, validation failed)
+PERMANENT_ERRORS=(400, 401, 403, 409, 422)
+
 _METHOD_MAP = dict(
         GET=lambda: 'GET',
         PUT=lambda: 'PUT',
@@ -80,16 +99,40 @@ RW_SCOPE = 'user,public_repo,repo,repo:status,gist'
 def _encode_params(kw):
     '''
     Encode parameters.
+
+    >>> _encode_params(dict(state='open', per_page=100))
+    'state=open&per_page=100'
     '''
-    args = []
-    for k, v in kw.items():
-        try:
-            # Python 2
-            qv = v.encode('utf-8') if isinstance(v, unicode) else str(v)
-        except:
-            qv = v
-        args.append('%s=%s' % (k, urlquote(qv)))
-    return '&'.join(args)
+    return urlencode(kw, quote_via=urlquote)
+
+def _connect(scheme, netloc):
+    '''
+    Open a connection to netloc, through the environment's proxy if any.
+    Returns the connection and, for plain http through a proxy, the extra
+    headers to send along with absolute request urls; otherwise None.
+    '''
+    conn_class = HTTPSConnection if scheme=='https' else HTTPConnection
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(netloc.split(':')[0]):
+        return conn_class(netloc, timeout=TIMEOUT), None
+    p = urlsplit(proxy if '://' in proxy else 'http://%s' % proxy)
+    headers = {}
+    if p.username:
+        userandpass = '%s:%s' % (unquote(p.username), unquote(p.password or ''))
+        userandpass = base64.b64encode(bytes(userandpass, 'utf-8')).decode('ascii')
+        headers['Proxy-Authorization'] = 'Basic %s' % userandpass
+    if scheme=='https':
+        conn = HTTPSConnection(p.hostname, p.port or 80, timeout=TIMEOUT)
+        conn.set_tunnel(netloc, headers=headers)
+        return conn, None
+    return HTTPConnection(p.hostname, p.port or 80, timeout=TIMEOUT), headers
+
+def _jitter(backoff):
+    '''
+    Stretch a backoff by up to half again, so clients that failed together
+    don't all come back at the same moment.
+    '''
+    return backoff * random.uniform(1, 1.5)
 
 def _encode_json(obj):
     '''
@@ -98,20 +141,48 @@ def _encode_json(obj):
     def _dump_obj(obj):
         if isinstance(obj, dict):
             return obj
-        d = dict()
-        for k in dir(obj):
-            if not k.startswith('_'):
-                d[k] = getattr(obj, k)
-        return d
+        try:
+            # just the object's own fields, rather than everything dir()
+            # turns up along its class hierarchy, methods included
+            fields = vars(obj)
+        except TypeError:
+            fields = dict((k, getattr(obj, k)) for k in dir(obj))
+        return dict((k, v) for k, v in fields.items() if not k.startswith('_'))
     return json.dumps(obj, default=_dump_obj)
 
 def _parse_json(jsonstr):
-    def _obj_hook(pairs):
-        o = JsonObject()
-        for k, v in pairs.items():
-            o[str(k)] = v
-        return o
-    return json.loads(jsonstr, object_hook=_obj_hook)
+    '''
+    Parse json, with every object a JsonObject. JsonObject takes a dict as
+    is, so the parser builds it without calling back into Python.
+    '''
+    return json.loads(jsonstr, object_hook=JsonObject)
+
+class _Pacer(object):
+    '''
+    When the next paced request may go out. GitHub counts the rate limit
+    against the account, so every client and thread using it shares one
+    schedule; threads pacing themselves separately would together go as
+    many times too fast as there are of them.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self, interval):
+        '''
+        Take the next free slot, interval after the one before it, and
+        return how long to sleep until it comes round.
+        '''
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + interval
+        return slot - now
+
+# (api url, authorization) -> _Pacer
+_pacers = {}
+_pacers_lock = threading.Lock()
 
 class _Executable(object):
 
@@ -140,17 +211,12 @@ class _Callable(object):
         name = '%s/%s' % (self._name, '/'.join([str(arg) for arg in args]))
         return _Callable(self._gh, name)
 
+    _VERBS = dict(get='GET', put='PUT', post='POST', patch='PATCH', delete='DELETE')
+
     def __getattr__(self, attr):
-        if attr=='get':
-            return _Executable(self._gh, 'GET', self._name)
-        if attr=='put':
-            return _Executable(self._gh, 'PUT', self._name)
-        if attr=='post':
-            return _Executable(self._gh, 'POST', self._name)
-        if attr=='patch':
-            return _Executable(self._gh, 'PATCH', self._name)
-        if attr=='delete':
-            return _Executable(self._gh, 'DELETE', self._name)
+        verb = _Callable._VERBS.get(attr)
+        if verb is not None:
+            return _Executable(self._gh, verb, self._name)
         name = '%s/%s' % (self._name, attr)
         return _Callable(self._gh, name)
 
@@ -165,7 +231,7 @@ class GitHub(object):
     GitHub client.
     '''
 
-    def __init__(self, username=None, password=None, access_token=None, client_id=None, client_secret=None, redirect_uri=None, scope=None, api_url=None):
+    def __init__(self, username=None, password=None, access_token=None, client_id=None, client_secret=None, redirect_uri=None, scope=None, api_url=None, etag_cache=None, ratelimit_pace_below=None):
         if api_url is not None:
             self._URL = api_url
         else:
@@ -181,10 +247,25 @@ class GitHub(object):
             self._authorization = 'Basic %s' % userandpass
         elif access_token:
             self._authorization = 'token %s' % access_token
+        # the same for every request, so built once; _http() and _send()
+        # copy rather than modify them
+        self._headers = {'User-Agent': 'githubpy/%s' % __version__}
+        if self._authorization:
+            self._headers['Authorization'] = self._authorization
+        self._body_headers = dict(self._headers, **{'Content-Type': 'application/json'})
         self._client_id = client_id
         self._client_secret = client_secret
         self._redirect_uri = redirect_uri
         self._scope = scope
+        # url -> [etag, body] of GETs from an earlier session, revalidated
+        # with If-None-Match; etag_cache collects the ones seen this session.
+        self._old_etag_cache = etag_cache or {}
+        self.etag_cache = {}
+        # (scheme, netloc) -> kept-alive connection, one set per thread
+        self._conns = threading.local()
+        self._ratelimit_pace_below = ratelimit_pace_below
+        with _pacers_lock:
+            self._pacer = _pacers.setdefault((self._URL, self._authorization), _Pacer())
 
     def authorize_url(self, state=None):
         '''
@@ -228,68 +309,196 @@ class GitHub(object):
         except HTTPError as e:
             raise ApiAuthError('HTTPError when get access token')
 
+    def graphql(self, query, **variables):
+        '''
+        Run a GraphQL query and return its data member. GitHub reports
+        query errors with a 200 response, so they are raised as ApiError.
+        '''
+        if self._URL.endswith('/v3'):
+            # GitHub Enterprise serves GraphQL next to, not under, /api/v3
+            url = '%sgraphql' % self._URL[:-2]
+        else:
+            url = '%s/graphql' % self._URL
+        r = self._http('POST', url, query=query, variables=variables)
+        if r.get('errors'):
+            raise ApiError(url, JsonObject(method='POST', url=url), JsonObject(code=200, json=r))
+        return r.data
+
     def __getattr__(self, attr):
         return _Callable(self, '/%s' % attr)
 
     def _http(self, _method, _path, **kw):
         nretries = 10
+        nwaits = MAX_RATELIMIT_WAITS
         data = None
         params = None
         if _method=='GET' and kw:
             _path = '%s?%s' % (_path, _encode_params(kw))
         if _method in ['POST', 'PATCH', 'PUT']:
             data = bytes(_encode_json(kw), 'utf-8')
-        url = '%s%s' % (self._URL, _path)
-        opener = build_opener(HTTPSHandler)
-        request = Request(url, data=data)
-        request.get_method = _METHOD_MAP[_method]
-        if self._authorization:
-            request.add_header('Authorization', self._authorization)
+        url = _path if '://' in _path else '%s%s' % (self._URL, _path)
         if _method in ['POST', 'PATCH', 'PUT']:
-            request.add_header('Content-Type', 'application/x-www-form-urlencoded')
+            headers = self._body_headers
+        else:
+            headers = self._headers
+        cached = None
+        if _method=='GET':
+            cached = self.etag_cache.get(url) or self._old_etag_cache.get(url)
+            if cached:
+                headers = dict(headers, **{'If-None-Match': cached[0]})
+        backoff = 1
         while True:
+            self._pace()
             try:
-                response = opener.open(request, timeout=TIMEOUT)
-                is_json = self._process_resp(response.headers)
-                if is_json:
-                    return _parse_json(response.read().decode('utf-8'))
-                if response.code == 204:
-                    return None
-            except HTTPError as e:
-                is_json = self._process_resp(e.headers)
+                response = self._open(_method, url, data, headers)
+            except (HTTPException, IOError) as e:
+                # a GET can't have done anything, so it's safe to send again
+                if _method!='GET' or nretries <= 0:
+                    raise
+                nretries -= 1
+                wait = _jitter(backoff)
+                print("temporary network error (%s) %s on %s, retrying in %.1fs up to %d times..." % (e, _method, _path, wait, nretries))
+                time.sleep(wait)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            body = response.read().decode('utf-8')
+            is_json = self._process_resp(response.headers)
+            if 200 <= response.status < 300:
                 if is_json:
-                    json = _parse_json(e.read().decode('utf-8'))
-                else:
-                    json = e.read().decode('utf-8')
-                req = JsonObject(method=_method, url=url)
-                resp = JsonObject(code=e.code, json=json)
-                if resp.code==404:
-                    raise ApiNotFoundError(url, req, resp)
-                if nretries > 0:
-                    nretries -= 1
-                    print("temporary HTTP error (%d) %s on %s with body %s, retrying up to %d times..." % (e.code, _method, _path, data, nretries))
-                    continue
+                    etag = response.getheader('ETag')
+                    if _method=='GET' and etag:
+                        self.etag_cache[url] = [etag, body]
+                    return _parse_json(body)
+                return None
+            if response.status==304 and cached:
+                # unchanged since we cached it; doesn't count against the rate limit
+                self.etag_cache[url] = cached
+                return _parse_json(cached[1])
+            if is_json:
+                json = _parse_json(body)
+            else:
+                json = body
+            req = JsonObject(method=_method, url=url)
+            resp = JsonObject(code=response.status, json=json)
+            if resp.code==404:
+                raise ApiNotFoundError(url, req, resp)
+            wait = self._ratelimit_wait(response, json)
+            if wait is not None:
+                # hammering away at a rate limit only makes github extend it
+                if nwaits <= 0 or wait > MAX_RATELIMIT_WAIT:
+                    raise ApiError(url, req, resp)
+                nwaits -= 1
+                print("rate limited (%d) %s on %s, retrying in %ds..." % (response.status, _method, _path, wait))
+                time.sleep(wait)
+                continue
+            if resp.code in PERMANENT_ERRORS:
                 raise ApiError(url, req, resp)
+            if nretries > 0:
+                nretries -= 1
+                wait = _jitter(backoff)
+                print("temporary HTTP error (%d) %s on %s with body %s, retrying in %.1fs up to %d times..." % (response.status, _method, _path, data, wait, nretries))
+                time.sleep(wait)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            raise ApiError(url, req, resp)
+
+    def _ratelimit_wait(self, response, json):
+        '''
+        How long github wants us to hold off before trying response's
+        request again, or None if it isn't a rate limit.
+        '''
+        retry_after = response.getheader('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        if response.status in (403, 429):
+            if self.x_ratelimit_remaining==0:
+                # out of calls: nothing gets through until the reset
+                return max(int(self.x_ratelimit_reset - time.time()) + 1, 1)
+            message = json.get('message', '') if isinstance(json, dict) else ''
+            if 'secondary rate limit' in message:
+                # github asks for at least a minute when it gives no hint
+                return 60
+        return None
+
+    def _pace(self):
+        '''
+        Once fewer than ratelimit_pace_below calls are left, spread the rest
+        evenly over the time until the limit resets, rather than spending
+        them in a burst and having every call after that refused.
+        '''
+        remaining = self.x_ratelimit_remaining
+        if self._ratelimit_pace_below is None or not 0 <= remaining < self._ratelimit_pace_below:
+            return
+        wait = self._pacer.wait((self.x_ratelimit_reset - time.time()) / (remaining + 1))
+        if wait > 0:
+            print("%d API calls left until the rate limit resets, waiting %.1fs" % (remaining, wait))
+            time.sleep(wait)
+
+    def _open(self, method, url, data, headers):
+        '''
+        Send a request, following redirects of GETs like urllib would.
+        '''
+        for i in range(5):
+            response = self._send(method, url, data, headers)
+            if method!='GET' or response.status not in (301, 302, 303, 307, 308):
+                break
+            response.read()
+            url = urljoin(url, response.getheader('Location'))
+        return response
+
+    def _send(self, method, url, data, headers):
+        '''
+        Send a request over this thread's kept-alive connection to the url's
+        host, saving a TCP and TLS handshake on every call after the first.
+        '''
+        parts = urlsplit(url)
+        conns = self._conns.__dict__
+        key = (parts.scheme, parts.netloc)
+        if key not in conns:
+            conns[key] = _connect(parts.scheme, parts.netloc)
+        conn, proxy_headers = conns[key]
+        if conn.sock is not None and select.select([conn.sock], [], [], 0)[0]:
+            # an idle connection only turns readable once the server hangs up
+            conn.close()
+        if proxy_headers is None:
+            target = parts.path + ('?%s' % parts.query if parts.query else '')
+        else:
+            target = url
+            headers = dict(headers, **proxy_headers)
+        try:
+            conn.request(method, target, body=data, headers=headers)
+            return conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
 
     def _process_resp(self, headers):
-        is_json = False
-        if headers:
-            for k in headers:
-                h = k.lower()
-                if h=='x-ratelimit-remaining':
-                    self.x_ratelimit_remaining = int(headers[k])
-                elif h=='x-ratelimit-limit':
-                    self.x_ratelimit_limit = int(headers[k])
-                elif h=='x-ratelimit-reset':
-                    self.x_ratelimit_reset = int(headers[k])
-                elif h=='content-type':
-                    is_json = headers[k].startswith('application/json')
-        return is_json
+        '''
+        Note the rate limit headers, and return whether the body is json.
+        Header lookups are case-insensitive already, and each is cheaper
+        than walking and lowercasing every header ourselves.
+        '''
+        if not headers:
+            return False
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            self.x_ratelimit_remaining = int(remaining)
+        limit = headers.get('X-RateLimit-Limit')
+        if limit is not None:
+            self.x_ratelimit_limit = int(limit)
+        reset = headers.get('X-RateLimit-Reset')
+        if reset is not None:
+            self.x_ratelimit_reset = int(reset)
+        return headers.get('Content-Type', '').startswith('application/json')
 
 class JsonObject(dict):
     '''
     general json object that can bind any fields but also act as a dict.
     '''
+    # fields live in the dict itself, so there's no need for room for an
+    # instance __dict__ (or weakrefs) on every one of these we parse
+    __slots__ = ()
+
     def __getattr__(self, key):
         try:
             return self[key]
@@ -7,9 +7,10 @@ setup(
     version=__version__,
     description='A continuous integration and automatic landing system for github pull requests.',
     author='Graydon Hoare',
-    py_modules=['bors', 'github'],
+    py_modules=['bors', 'bors_webhook', 'github'],
     entry_points={
-        'console_scripts': ['bors = bors:main'],
+        'console_scripts': ['bors = bors:main',
+                            'bors-webhook = bors_webhook:main'],
         'github': ['github = github']
     },
     zip_safe=False,